@@ -1,13 +1,19 @@
 from __future__ import annotations
 
 import os
-from dataclasses import dataclass
-from typing import Any, Optional
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, ClassVar, Iterator, Optional
 
-from sqlalchemy import create_engine, text
-from sqlalchemy.engine import Engine
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import URL, Connection, Engine, make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import SingletonThreadPool
+from sqlalchemy.sql.elements import TextClause
 
-from .schema import get_schema_sql
+from .schema import SCHEMA_VERSION, get_schema_sql
 
 # --- Connection string helpers ---
 #
@@ -27,6 +33,99 @@ DEFAULT_MYSQL_CONN_STR = os.environ.get(
 )
 
 
+# Applied to every new SQLite DBAPI connection. WAL + synchronous=NORMAL turns the
+# many small per-tool-call commits into log appends instead of full fsyncs.
+_SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA foreign_keys=ON",
+    # Refresh planner stats a fresh connection would otherwise start without.
+    "PRAGMA optimize=0x10002",
+)
+
+# Sessions re-run PRAGMA optimize as they end, at most this often.
+_SQLITE_OPTIMIZE_INTERVAL_S = 900.0
+
+# ...and run a PASSIVE WAL checkpoint at most this often. SQLite's own auto-checkpoint
+# gives up while readers are active, so a busy database can let the -wal file grow.
+_SQLITE_CHECKPOINT_INTERVAL_S = 60.0
+
+
+# An in-memory database has no file to journal or map, so WAL and mmap don't apply.
+_SQLITE_FILE_ONLY_PRAGMAS = ("PRAGMA journal_mode=WAL", "PRAGMA mmap_size=268435456")
+
+# NORMAL can lose the last commits on power loss (never on an app crash) but keeps
+# the database consistent; FULL/EXTRA fsync on every commit.
+_SQLITE_SYNCHRONOUS_LEVELS = ("off", "normal", "full", "extra")
+
+
+def _is_sqlite_memory(url: URL) -> bool:
+    # URI filenames (?uri=true) carry mode=memory in the URL's query, not its database.
+    database = url.database or ""
+    return (
+        database in ("", ":memory:")
+        or database.startswith("file::memory:")
+        or url.query.get("mode") == "memory"
+    )
+
+
+def _sqlite_pragmas(*, memory: bool, synchronous: str) -> tuple[str, ...]:
+    pragmas = []
+    for pragma in _SQLITE_PRAGMAS:
+        if memory and pragma in _SQLITE_FILE_ONLY_PRAGMAS:
+            continue
+        if pragma.startswith("PRAGMA synchronous="):
+            pragma = f"PRAGMA synchronous={synchronous.upper()}"
+        pragmas.append(pragma)
+    return tuple(pragmas)
+
+
+def _sqlite_synchronous() -> str:
+    level = (os.environ.get("AGENTTRAIL_SQLITE_SYNCHRONOUS") or "normal").strip().lower()
+    if level not in _SQLITE_SYNCHRONOUS_LEVELS:
+        raise ValueError(f"Unsupported AGENTTRAIL_SQLITE_SYNCHRONOUS: {level!r}")
+    return level
+
+
+def _sqlite_connect_listener(pragmas: tuple[str, ...]) -> Callable[[Any, Any], None]:
+    def configure(dbapi_connection: Any, connection_record: Any) -> None:
+        _run_pragmas(dbapi_connection, pragmas)
+
+    return configure
+
+
+def _run_pragmas(dbapi_connection: Any, pragmas: tuple[str, ...]) -> None:
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma in pragmas:
+            cursor.execute(pragma)
+    finally:
+        cursor.close()
+
+
+def _env_flag(name: str) -> Optional[bool]:
+    raw = os.environ.get(name)
+    if raw is None or not raw.strip():
+        return None
+    return raw.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _env_int(name: str) -> Optional[int]:
+    raw = os.environ.get(name)
+    if raw is None or not raw.strip():
+        return None
+    try:
+        value = int(raw.strip())
+    except ValueError:
+        raise ValueError(f"{name} must be an integer, got {raw!r}") from None
+    if value < 0:
+        raise ValueError(f"{name} must be non-negative, got {raw!r}")
+    return value
+
+
 def sqlite_connection_string(path: str = DEFAULT_SQLITE_PATH) -> str:
     # Accept either relative or absolute paths.
     if path.startswith("/"):
@@ -49,22 +148,185 @@ def mysql_connection_string(
     )
 
 
+# A fixed name instead of begin_nested(), whose numbered sa_savepoint_N names are
+# new SQL text every time and would churn the driver's prepared-statement cache.
+_SAVEPOINT = "SAVEPOINT agentrelay_claim"
+_RELEASE_SAVEPOINT = "RELEASE SAVEPOINT agentrelay_claim"
+_ROLLBACK_TO_SAVEPOINT = "ROLLBACK TO SAVEPOINT agentrelay_claim"
+
+
+def _run_sqlite_schema_statements(sqlite_conn: Any, schema_sql: str) -> None:
+    sqlite_conn.execute("BEGIN IMMEDIATE")
+    try:
+        for statement in schema_sql.split(";"):
+            stmt = statement.strip()
+            if not stmt:
+                continue
+            try:
+                sqlite_conn.execute(stmt)
+            except sqlite3.Error as e:
+                raise RuntimeError(f"Schema statement failed: {stmt}") from e
+        sqlite_conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    except BaseException:
+        sqlite_conn.rollback()
+        raise
+    sqlite_conn.commit()
+
+
+def _as_text(sql: str | TextClause) -> TextClause:
+    # Callers on hot paths pass module-level text() constants; skip re-wrapping them.
+    if isinstance(sql, TextClause):
+        return sql
+    return text(sql)
+
+
+@dataclass(slots=True)
+class SessionConnection:
+    """A session's connection, checked out on first use and reused until released.
+
+    Each call still runs in its own short transaction so claims become visible to
+    other connections immediately and no write lock is held across tool execution.
+    The session releases the connection back to the pool while user code runs, so
+    open sessions only hold one while they are talking to the database.
+    """
+
+    engine: Engine
+    _conn: Optional[Connection] = field(default=None, init=False)
+    _lock: threading.RLock = field(default_factory=threading.RLock, init=False)
+
+    def __enter__(self) -> "SessionConnection":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    @property
+    def conn(self) -> Connection:
+        # Caller holds _lock.
+        if self._conn is None:
+            self._conn = self.engine.connect()
+        return self._conn
+
+    def release(self) -> None:
+        """Return the connection to the pool; the next statement checks one out again."""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def close(self) -> None:
+        self.release()
+
+    def execute(self, sql: str | TextClause, params: dict | None = None) -> None:
+        with self._lock, self.conn.begin():
+            self.conn.execute(_as_text(sql), params or {})
+
+    def execute_batches(self, batches: list[tuple[str | TextClause, list[dict]]]) -> None:
+        """Run several executemany() batches in one transaction.
+
+        Callers build every parameter list up front so the transaction only
+        spans the driver calls.
+        """
+        if not batches:
+            return
+        with self._lock, self.conn.begin():
+            for sql, params_list in batches:
+                self.conn.execute(_as_text(sql), params_list)
+
+    def insert_unique(
+        self,
+        sql: str | TextClause,
+        params: dict,
+        batches: list[tuple[str | TextClause, list[dict]]] | None = None,
+    ) -> bool:
+        """INSERT a row guarded by a unique index, committing `batches` in the same transaction.
+
+        Returns False if the row already exists. The batches are committed either way.
+        """
+        with self._lock:
+            if not batches:
+                try:
+                    with self.conn.begin():
+                        self.conn.execute(_as_text(sql), params)
+                except IntegrityError:
+                    return False
+                return True
+
+            with self.conn.begin():
+                for batch_sql, params_list in batches:
+                    self.conn.execute(_as_text(batch_sql), params_list)
+                # Roll back only the INSERT on a conflict, keeping the batches.
+                self.conn.exec_driver_sql(_SAVEPOINT)
+                try:
+                    self.conn.execute(_as_text(sql), params)
+                except IntegrityError:
+                    self.conn.exec_driver_sql(_ROLLBACK_TO_SAVEPOINT)
+                    return False
+                self.conn.exec_driver_sql(_RELEASE_SAVEPOINT)
+            return True
+
+    def fetchone(self, sql: str | TextClause, params: dict | None = None) -> Any:
+        with self._lock, self.conn.begin():
+            return self.conn.execute(_as_text(sql), params or {}).fetchone()
+
+    def fetchall(self, sql: str | TextClause, params: dict | None = None) -> list[Any]:
+        with self._lock, self.conn.begin():
+            return list(self.conn.execute(_as_text(sql), params or {}))
+
+
 @dataclass
 class Database:
     engine: Engine
 
+    # Server databases already brought up to SCHEMA_VERSION by this process.
+    _schemas_initialized: ClassVar[set[tuple[str, int]]] = set()
+
+    _last_optimize: float = field(default_factory=time.monotonic, init=False)
+    _last_checkpoint: float = field(default_factory=time.monotonic, init=False)
+
     @classmethod
     def from_connection_string(cls, conn_str: str) -> "Database":
+        is_sqlite = conn_str.lower().startswith("sqlite")
+
+        # Pre-ping guards against server-side disconnects; an embedded SQLite
+        # file can't drop a pooled connection, so the extra SELECT 1 is skipped.
+        pre_ping = _env_flag("AGENTTRAIL_DB_POOL_PRE_PING")
         engine_kwargs: dict[str, Any] = {
             "future": True,
-            "pool_pre_ping": True,
+            "pool_pre_ping": (not is_sqlite) if pre_ping is None else pre_ping,
         }
 
+        # Connections come from SQLAlchemy's bounded QueuePool and are returned to
+        # it after each session, so threads that come and go don't each keep one.
+        pool_size = _env_int("AGENTTRAIL_DB_POOL_SIZE")
+        max_overflow = _env_int("AGENTTRAIL_DB_MAX_OVERFLOW")
+
         # SQLite defaults are a bit restrictive for multi-threaded apps.
-        if conn_str.lower().startswith("sqlite"):
+        if is_sqlite:
             engine_kwargs["connect_args"] = {"check_same_thread": False}
+            # In-memory databases use a per-thread pool that takes no size limits.
+            # SQLAlchemy only infers it for ':memory:', so name it for URI forms too.
+            if _is_sqlite_memory(make_url(conn_str)):
+                engine_kwargs["poolclass"] = SingletonThreadPool
+            else:
+                if pool_size is not None:
+                    engine_kwargs["pool_size"] = pool_size
+                if max_overflow is not None:
+                    engine_kwargs["max_overflow"] = max_overflow
+        else:
+            engine_kwargs.update(
+                pool_size=10 if pool_size is None else pool_size,
+                max_overflow=5 if max_overflow is None else max_overflow,
+                pool_recycle=1800,
+            )
 
         engine = create_engine(conn_str, **engine_kwargs)
+        if is_sqlite:
+            # Lock waits are covered by pysqlite's own busy timeout (timeout=5.0).
+            pragmas = _sqlite_pragmas(
+                memory=_is_sqlite_memory(engine.url), synchronous=_sqlite_synchronous()
+            )
+            event.listen(engine, "connect", _sqlite_connect_listener(pragmas))
         db = cls(engine=engine)
         db.create_schema_if_needed()
         return db
@@ -86,13 +348,18 @@ class Database:
         return cls.from_connection_string(conn_str)
 
     def create_schema_if_needed(self) -> None:
-        schema_sql = get_schema_sql(self.engine.dialect.name)
+        dialect_name = (self.engine.dialect.name or "").lower()
+        if dialect_name.startswith("sqlite"):
+            self._create_sqlite_schema_if_needed()
+            return
 
-        with self.engine.begin() as conn:
-            # Enable FK enforcement on SQLite.
-            if (self.engine.dialect.name or "").lower().startswith("sqlite"):
-                conn.exec_driver_sql("PRAGMA foreign_keys = ON")
+        memo_key = (str(self.engine.url), SCHEMA_VERSION)
+        if memo_key in Database._schemas_initialized:
+            return
 
+        schema_sql = get_schema_sql(dialect_name)
+
+        with self.engine.begin() as conn:
             for statement in schema_sql.split(";"):
                 stmt = statement.strip()
                 if not stmt:
@@ -109,16 +376,103 @@ class Database:
                         continue
                     raise
 
-    def execute(self, sql: str, params: dict | None = None) -> None:
+        Database._schemas_initialized.add(memo_key)
+
+    def _create_sqlite_schema_if_needed(self) -> None:
+        # PRAGMA user_version records the schema version, so a warm start is a
+        # single read. Otherwise the whole DDL script runs in one executescript()
+        # call and one transaction, and bumps the version in the same commit.
+        raw = self.engine.raw_connection()
+        try:
+            sqlite_conn = raw.driver_connection
+            if sqlite_conn is None:
+                raise RuntimeError("Pooled SQLite connection was invalidated")
+            (version,) = sqlite_conn.execute("PRAGMA user_version").fetchone()
+            if version >= SCHEMA_VERSION:
+                return
+            schema_sql = get_schema_sql("sqlite")
+            try:
+                sqlite_conn.executescript(
+                    "BEGIN IMMEDIATE;\n"
+                    f"{schema_sql}\n"
+                    f"PRAGMA user_version = {SCHEMA_VERSION};\n"
+                    "COMMIT;"
+                )
+            except sqlite3.Error:
+                # executescript() stops mid-script with the transaction open. Start
+                # over one statement at a time, which either gets through (e.g. the
+                # failure was a transient lock) or names the statement that fails.
+                if sqlite_conn.in_transaction:
+                    sqlite_conn.rollback()
+                _run_sqlite_schema_statements(sqlite_conn, schema_sql)
+        finally:
+            raw.close()
+
+    def maybe_optimize(self) -> None:
+        """Run SQLite's PRAGMA optimize if the interval has passed since the last run."""
+        if self.engine.dialect.name != "sqlite":
+            return
+        now = time.monotonic()
+        if now - self._last_optimize < _SQLITE_OPTIMIZE_INTERVAL_S:
+            return
+        self._last_optimize = now
+        try:
+            with self.engine.begin() as conn:
+                conn.exec_driver_sql("PRAGMA optimize")
+        except Exception:
+            # Best-effort: stale planner stats shouldn't fail the caller.
+            pass
+
+    def maybe_checkpoint(self) -> None:
+        """Run a PASSIVE WAL checkpoint if the interval has passed since the last one."""
+        if self.engine.dialect.name != "sqlite":
+            return
+        now = time.monotonic()
+        if now - self._last_checkpoint < _SQLITE_CHECKPOINT_INTERVAL_S:
+            return
+        self._last_checkpoint = now
+        self._checkpoint("PASSIVE")
+
+    def close(self) -> None:
+        """Release pooled connections; on SQLite, first fold the WAL back and truncate it."""
+        if self.engine.dialect.name == "sqlite":
+            self._checkpoint("TRUNCATE")
+        self.engine.dispose()
+
+    def _checkpoint(self, mode: str) -> None:
+        if _is_sqlite_memory(self.engine.url):
+            return
+        try:
+            with self.engine.connect() as conn:
+                conn.exec_driver_sql(f"PRAGMA wal_checkpoint({mode})")
+        except Exception:
+            # Best-effort: a checkpoint blocked by a writer simply happens next time.
+            pass
+
+    def session_connection(self) -> SessionConnection:
+        return SessionConnection(self.engine)
+
+    def execute(self, sql: str | TextClause, params: dict | None = None) -> None:
         with self.engine.begin() as conn:
-            conn.execute(text(sql), params or {})
+            conn.execute(_as_text(sql), params or {})
 
-    def fetchone(self, sql: str, params: dict | None = None) -> Any:
+    def fetchone(self, sql: str | TextClause, params: dict | None = None) -> Any:
         with self.engine.begin() as conn:
-            result = conn.execute(text(sql), params or {})
+            result = conn.execute(_as_text(sql), params or {})
             return result.fetchone()
 
-    def fetchall(self, sql: str, params: dict | None = None) -> list[Any]:
+    def fetchall(self, sql: str | TextClause, params: dict | None = None) -> list[Any]:
         with self.engine.begin() as conn:
-            result = conn.execute(text(sql), params or {})
+            result = conn.execute(_as_text(sql), params or {})
             return list(result)
+
+    def iter_rows(
+        self, sql: str | TextClause, params: dict | None = None, batch_size: int = 500
+    ) -> Iterator[Any]:
+        # yield_per streams from a server-side cursor where the driver has one
+        # (MySQL, Postgres); SQLite just fetches in batches.
+        with self.engine.connect() as conn:
+            result = conn.execution_options(yield_per=batch_size).execute(
+                _as_text(sql), params or {}
+            )
+            yield from result
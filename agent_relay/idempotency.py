@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import struct
+from functools import partial
+from typing import Any, Callable, Optional
+
+from .util import first, walk
+
+# Idempotency keys are a 256-bit digest of a type-tagged, length-prefixed encoding of
+# (tool_name, phase, args, kwargs), streamed straight into the hasher so no
+# intermediate JSON string is ever built. Tags keep values that would otherwise
+# encode alike apart: "1" vs 1, 1 vs 1.0, ["ab"] vs ["a", "b"].
+#
+# Like the JSON form it replaces, lists and tuples hash the same, dict keys are
+# order-insensitive, and anything that isn't a JSON-ish primitive or container
+# is hashed by its repr().
+
+# SHA-256 unless AGENTTRAIL_IDEMPOTENCY_HASH=blake3 opts in. This is never switched
+# automatically: every process writing to a database must agree on the hash, or
+# the same call gets two keys and runs twice.
+_hasher_factory: Optional[Callable[[], Any]] = None
+
+
+def _new_hasher() -> Any:
+    # Resolved on first use, so a bad setting fails the first keyed call instead
+    # of `import agent_relay`.
+    global _hasher_factory
+    if _hasher_factory is None:
+        _hasher_factory = _resolve_hasher()
+    return _hasher_factory()
+
+
+def _resolve_hasher() -> Callable[[], Any]:
+    name = os.environ.get("AGENTTRAIL_IDEMPOTENCY_HASH", "").strip().lower() or "sha256"
+    if name == "blake3":
+        # pip install agentrelay[blake3]; optional, so there may be no stubs to check against.
+        from blake3 import blake3  # type: ignore[import-not-found]
+
+        return blake3
+    if name == "sha256":
+        return hashlib.sha256
+    raise ValueError(f"Unsupported AGENTTRAIL_IDEMPOTENCY_HASH: {name!r}")
+
+
+_LEN = struct.Struct("<Q")
+_FLOAT = struct.Struct("<d")
+
+
+def compute_idempotency_key(tool_name: str, phase: str, args: tuple, kwargs: dict) -> str:
+    h = _new_hasher()
+    flat = _flat_encoding(tool_name, phase, args, kwargs)
+    if flat is not None:
+        h.update(flat)
+    else:
+        _update(h, tool_name)
+        _update(h, phase)
+        _update(h, args)
+        _update(h, kwargs)
+    return h.hexdigest()
+
+
+def derive_idempotency_key(parent_key: str, tool_name: str, phase: str) -> str:
+    """Key for a call fully determined by an earlier one, e.g. a step's compensation.
+
+    Hashes the parent's key instead of re-walking the (identical) arguments.
+    """
+    h = _new_hasher()
+    _update(h, tool_name)
+    _update(h, phase)
+    _update(h, parent_key)
+    return h.hexdigest()
+
+
+def _encode_str(value: str) -> bytes:
+    b = value.encode("utf-8")
+    return b"s" + _LEN.pack(len(b)) + b
+
+
+def _encode_int(value: int) -> bytes:
+    b = str(value).encode("ascii")
+    return b"i" + _LEN.pack(len(b)) + b
+
+
+# Exact types only: subclasses (IntEnum, str enums, ...) go through _update().
+_LEAF_ENCODERS: dict[type, Callable[[Any], bytes]] = {
+    str: _encode_str,
+    int: _encode_int,
+    float: lambda value: b"F" + _FLOAT.pack(value),
+    bool: lambda value: b"t" if value else b"f",
+    type(None): lambda value: b"n",
+}
+
+
+def _flat_encoding(tool_name: str, phase: str, args: tuple, kwargs: dict) -> Optional[bytes]:
+    """The bytes _update() would stream, built in one join when every argument is a scalar.
+
+    Returns None as soon as a container or other type shows up.
+    """
+    enc = _LEAF_ENCODERS
+    try:
+        parts = [_encode_str(tool_name), _encode_str(phase), b"l" + _LEN.pack(len(args))]
+        parts.extend([enc[type(a)](a) for a in args])
+        parts.append(b"d" + _LEN.pack(len(kwargs)))
+        for k in sorted(kwargs):
+            parts.append(enc[type(k)](k))
+            v = kwargs[k]
+            parts.append(enc[type(v)](v))
+    except (KeyError, TypeError):
+        return None
+    return b"".join(parts)
+
+
+def _write(h: Any, tag: bytes, payload: bytes) -> None:
+    h.update(tag + _LEN.pack(len(payload)))
+    h.update(payload)
+
+
+def _update(h: Any, value: Any) -> None:
+    walk(value, partial(_hash_node, h))
+
+
+def _hash_node(h: Any, value: Any) -> Optional[tuple]:
+    # A container writes its header and hands back its children, which the walk
+    # hashes next and in order.
+    if value is None:
+        h.update(b"n")
+    elif value is True:
+        h.update(b"t")
+    elif value is False:
+        h.update(b"f")
+    elif isinstance(value, str):
+        _write(h, b"s", value.encode("utf-8"))
+    elif isinstance(value, int):
+        _write(h, b"i", str(int(value)).encode("ascii"))
+    elif isinstance(value, float):
+        h.update(b"F" + _FLOAT.pack(value))
+    elif isinstance(value, dict):
+        h.update(b"d" + _LEN.pack(len(value)))
+        return value, [x for item in _sorted_items(value) for x in item]
+    elif isinstance(value, (list, tuple)):
+        h.update(b"l" + _LEN.pack(len(value)))
+        return value, value
+    else:
+        _write(h, b"r", repr(value).encode("utf-8"))
+    return None
+
+
+def _sorted_items(value: dict) -> list:
+    try:
+        return sorted(value.items(), key=first)
+    except TypeError:
+        # Mixed key types aren't mutually orderable; fall back to a stable textual order.
+        return sorted(value.items(), key=lambda kv: (type(kv[0]).__name__, repr(kv[0])))
@@ -8,7 +8,7 @@ from typing import Any, Callable, Optional
 from .context import get_current_session
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class LLMUsage:
     provider: str
     model: str
@@ -24,10 +24,15 @@ def _calculate_cost(tokens: int, rate_per_1k: float) -> float:
     return round((tokens / 1000.0) * rate_per_1k, 6)
 
 
+# json.dumps() builds a new encoder whenever it's given options; reuse one. The
+# output must stay byte-identical, since stored fingerprints are idempotency keys.
+_FINGERPRINT_ENCODER = json.JSONEncoder(sort_keys=True, default=repr)
+
+
 def _request_fingerprint(payload: Optional[dict[str, Any]]) -> Optional[str]:
     if payload is None:
         return None
-    json_str = json.dumps(payload, sort_keys=True, default=repr)
+    json_str = _FINGERPRINT_ENCODER.encode(payload)
     return hashlib.sha256(json_str.encode("utf-8")).hexdigest()
 
 
@@ -119,7 +124,8 @@ def wrap_openai_call(
     session = get_current_session()
     if session is None:
         return call()
-    request_fingerprint = _request_fingerprint(request_payload)
+    # Replay answers from the recorded run and never looks at the fingerprint.
+    request_fingerprint = None if session.replay else _request_fingerprint(request_payload)
     return session.execute_llm_call(
         provider=provider,
         model=model,
@@ -145,7 +151,8 @@ def wrap_anthropic_call(
     session = get_current_session()
     if session is None:
         return call()
-    request_fingerprint = _request_fingerprint(request_payload)
+    # Replay answers from the recorded run and never looks at the fingerprint.
+    request_fingerprint = None if session.replay else _request_fingerprint(request_payload)
     return session.execute_llm_call(
         provider=provider,
         model=model,
@@ -171,7 +178,8 @@ def wrap_ollama_call(
     session = get_current_session()
     if session is None:
         return call()
-    request_fingerprint = _request_fingerprint(request_payload)
+    # Replay answers from the recorded run and never looks at the fingerprint.
+    request_fingerprint = None if session.replay else _request_fingerprint(request_payload)
     return session.execute_llm_call(
         provider=provider,
         model=model,
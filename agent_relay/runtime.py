@@ -1,15 +1,19 @@
 from __future__ import annotations
 
-import hashlib
+import itertools
 import json
+import os
+import sys
 import threading
 import time
-import uuid
+from collections import OrderedDict
 from dataclasses import dataclass, field
-from datetime import datetime
-from typing import Any, Callable, Dict, List, Optional
+from datetime import datetime, timedelta
+from operator import attrgetter
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set
 
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import text
+from sqlalchemy.sql.elements import TextClause
 
 from .context import (
     get_current_tool_call_id,
@@ -17,38 +21,413 @@ from .context import (
     set_current_session,
     set_current_tool_call_id,
 )
-from .db import Database
+from .db import Database, SessionConnection
+from .idempotency import compute_idempotency_key, derive_idempotency_key
 from .llm import LLMUsage
+from .util import first, intern_name, walk
+
+try:  # Optional: pip install agentrelay[fast]
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None  # type: ignore[assignment]
 
 ToolCall = Callable[..., Any]
 
+# Statements are built once so SQLAlchemy can reuse their compiled form.
+_SQL_INSERT_AGENT_RUN = text(
+    """
+    INSERT INTO agent_runs (
+        id, name, status, tags, budget_limit,
+        total_prompt_tokens, total_completion_tokens, total_tokens, total_cost,
+        input_json, created_at, updated_at
+    ) VALUES (
+        :id, :name, :status, :tags, :budget_limit,
+        :pt, :ct, :tt, :tc,
+        :input_json, :created_at, :updated_at
+    )
+    """
+)
+
+_SQL_UPDATE_AGENT_RUN_FINAL = text(
+    """
+    UPDATE agent_runs
+    SET status = :status,
+        output_json = :output_json,
+        error = :error,
+        total_prompt_tokens = :pt,
+        total_completion_tokens = :ct,
+        total_tokens = :tt,
+        total_cost = :tc,
+        updated_at = :updated_at
+    WHERE id = :id
+    """
+)
+
+_SQL_INSERT_TOOL_CALL = text(
+    """
+    INSERT INTO tool_calls (
+        id, run_id, seq_no, tool_name, idempotency_key,
+        phase, status,
+        parent_tool_call_id, internal,
+        provider, model, request_fingerprint,
+        input_json, created_at, updated_at
+    ) VALUES (
+        :id, :run_id, :seq_no, :tool_name, :idem,
+        :phase, :status,
+        :parent_tool_call_id, :internal,
+        :provider, :model, :request_fingerprint,
+        :input_json, :created_at, :updated_at
+    )
+    """
+)
+
+_SQL_UPDATE_TOOL_CALL_FINISHED = text(
+    """
+    UPDATE tool_calls
+    SET status = :status,
+        output_json = :output_json,
+        prompt_tokens = :prompt_tokens,
+        completion_tokens = :completion_tokens,
+        total_tokens = :total_tokens,
+        input_cost = :input_cost,
+        output_cost = :output_cost,
+        total_cost = :total_cost,
+        error = :error,
+        updated_at = :updated_at
+    WHERE id = :id
+    """
+)
+
+# Non-idempotent calls have no claim to publish, so they are written once, already finished.
+_SQL_INSERT_TOOL_CALL_FINISHED = text(
+    """
+    INSERT INTO tool_calls (
+        id, run_id, seq_no, tool_name, idempotency_key, phase, status,
+        parent_tool_call_id, internal, provider, model, request_fingerprint,
+        input_json, output_json, prompt_tokens, completion_tokens, total_tokens,
+        input_cost, output_cost, total_cost, error, created_at, updated_at
+    ) VALUES (
+        :id, :run_id, :seq_no, :tool_name, :idem, :phase, :status,
+        :parent_tool_call_id, :internal, :provider, :model, :request_fingerprint,
+        :input_json, :output_json, :prompt_tokens, :completion_tokens, :total_tokens,
+        :input_cost, :output_cost, :total_cost, :error, :created_at, :updated_at
+    )
+    """
+)
+
+_USAGE_FIELDS = (
+    "prompt_tokens",
+    "completion_tokens",
+    "total_tokens",
+    "input_cost",
+    "output_cost",
+    "total_cost",
+)
+_get_usage = attrgetter(*_USAGE_FIELDS)
+_NO_USAGE = dict.fromkeys(_USAGE_FIELDS)
+_NO_RESULT = {"output_json": None, **_NO_USAGE}
+
+
+def _usage_bind(usage: Optional[LLMUsage]) -> dict:
+    if usage is None:
+        return _NO_USAGE
+    return dict(zip(_USAGE_FIELDS, _get_usage(usage)))
+
+
+_SQL_SELECT_EXISTING_CALL = text(
+    """
+    SELECT status, output_json, error
+    FROM tool_calls
+    WHERE run_id = :run_id
+      AND tool_name = :tool_name
+      AND idempotency_key = :idem
+      AND phase = :phase
+    """
+)
+
+# Only what _replay_step reads: input_json is usually the largest column and
+# replay never looks at it.
+_SQL_SELECT_REPLAY_CALLS = text(
+    """
+    SELECT tool_name, phase, status, output_json
+    FROM tool_calls
+    WHERE run_id = :run_id
+    ORDER BY seq_no ASC
+    """
+)
+
+# Export rows are built by zipping these with positional rows, so the SELECTs
+# are generated from the same tuples to keep them in step.
+_RUN_EXPORT_COLS = (
+    "id", "name", "status", "tags", "budget_limit", "total_prompt_tokens",
+    "total_completion_tokens", "total_tokens", "total_cost", "input_json", "output_json",
+    "error", "replay_of", "created_at", "updated_at",
+)
+_TOOL_CALL_EXPORT_COLS = (
+    "id", "seq_no", "tool_name", "idempotency_key", "phase", "status", "parent_tool_call_id",
+    "internal", "provider", "model", "request_fingerprint", "prompt_tokens",
+    "completion_tokens", "total_tokens", "input_cost", "output_cost", "total_cost",
+    "input_json", "output_json", "error", "created_at", "updated_at",
+)
+
+_SQL_SELECT_RUN_EXPORT = text(
+    f"SELECT {', '.join(_RUN_EXPORT_COLS)} FROM agent_runs WHERE id = :id"
+)
+_SQL_SELECT_TOOL_CALLS_EXPORT = text(
+    f"SELECT {', '.join(_TOOL_CALL_EXPORT_COLS)} FROM tool_calls"
+    " WHERE run_id = :run_id ORDER BY seq_no ASC"
+)
+
 
 class BudgetExceededError(RuntimeError):
     pass
 
 
+_LEAF, _MAP, _SEQ, _OTHER = range(4)
+_JSON_KINDS = {
+    str: _LEAF,
+    int: _LEAF,
+    float: _LEAF,
+    bool: _LEAF,
+    type(None): _LEAF,
+    dict: _MAP,
+    list: _SEQ,
+    tuple: _SEQ,
+}
+
+
+def _json_kind(value: Any) -> int:
+    kind = _JSON_KINDS.get(type(value))
+    if kind is not None:
+        return kind
+    # Subclasses (IntEnum, OrderedDict, namedtuple, ...) take the slow path.
+    if isinstance(value, (str, int, float, bool)):
+        return _LEAF
+    if isinstance(value, dict):
+        return _MAP
+    if isinstance(value, (list, tuple)):
+        return _SEQ
+    return _OTHER
+
+
 def _serialize_json(data: Any) -> Any:
-    """Best-effort JSON serialization for logging inputs/outputs."""
-    if data is None or isinstance(data, (str, int, float, bool)):
-        return data
-    if isinstance(data, dict):
-        return {str(k): _serialize_json(v) for k, v in data.items()}
-    if isinstance(data, (list, tuple)):
-        return [_serialize_json(v) for v in data]
-    # Fall back to a repr so we never crash logging.
-    return repr(data)
+    """Best-effort JSON serialization for logging inputs/outputs.
+
+    Walks the payload with an explicit stack, so deep nesting can't hit the
+    recursion limit. Like json.dumps(), raises ValueError on a circular reference.
+    """
+    root: List[Any] = [None]
+
+    def visit(entry: tuple) -> Optional[tuple]:
+        value, out, slot = entry
+        kind = _json_kind(value)
+        if kind is _LEAF:
+            out[slot] = value
+            return None
+        if kind is _OTHER:
+            # Fall back to a repr so we never crash logging.
+            out[slot] = repr(value)
+            return None
+        if kind is _MAP:
+            node: Dict[str, Any] = {}
+            out[slot] = node
+            items = [(str(k), v) for k, v in value.items()]
+            for key, _ in items:
+                node[key] = None
+            # Entries are filled in order, so a later key that stringifies the same still wins.
+            return value, [(v, node, key) for key, v in items]
+        seq: List[Any] = [None] * len(value)
+        out[slot] = seq
+        return value, [(v, seq, i) for i, v in enumerate(value)]
+
+    walk((data, root, 0), visit)
+    return root[0]
+
+
+# Dataclasses and datetimes pass through to repr() like every other unknown type.
+_ORJSON_OPTIONS = (
+    orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_PASSTHROUGH_DATETIME
+    if orjson is not None
+    else 0
+)
+
+
+# Encodings of the most common payloads: tools returning None, and calls with no arguments.
+_NULL_JSON = "null"
+_EMPTY_CALL_JSON = '{"args":[],"kwargs":{}}'
+
+
+def _dumps(data: Any) -> str:
+    """Encode a payload for a JSON column in a single C-level pass."""
+    if data is None:
+        return _NULL_JSON
+    try:
+        if orjson is not None:
+            return orjson.dumps(data, default=repr, option=_ORJSON_OPTIONS).decode("utf-8")
+        return json.dumps(data, default=repr, separators=(",", ":"), ensure_ascii=False)
+    except (TypeError, ValueError):
+        # e.g. tuple dict keys or ints wider than 64 bits: normalize in Python first.
+        return json.dumps(_serialize_json(data), separators=(",", ":"), ensure_ascii=False)
+
+
+def _new_id() -> str:
+    """RFC 9562 version-7 UUID string, without building a uuid.UUID object.
+
+    The millisecond timestamp prefix (plus a 12-bit sub-millisecond fraction)
+    makes new ids sort after old ones, so primary-key inserts land on the
+    right edge of the index instead of a random leaf page.
+    """
+    ms, ns = divmod(time.time_ns(), 1_000_000)
+    sub_ms = ns * 4096 // 1_000_000
+    b = bytearray(ms.to_bytes(6, "big") + os.urandom(10))
+    b[6] = 0x70 | (sub_ms >> 8)
+    b[7] = sub_ms & 0xFF
+    b[8] = (b[8] & 0x3F) | 0x80
+    h = b.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _utcnow() -> datetime:
+    # Naive UTC, matching what datetime.utcnow() stored, without its 3.12 deprecation.
+    # Offsetting the epoch by time_ns() skips building an aware datetime and then
+    # replace()-ing its tzinfo away, about half the cost.
+    return _EPOCH + timedelta(0, 0, time.time_ns() // 1000)
+
+
+class _LockedCounter:
+    """itertools.count() for free-threaded builds, where next() on it isn't atomic."""
+
+    def __init__(self) -> None:
+        self._count = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def __iter__(self) -> "_LockedCounter":
+        return self
+
+    def __next__(self) -> int:
+        with self._lock:
+            return next(self._count)
+
+
+def _new_seq_counter() -> Iterator[int]:
+    # With the GIL, count.__next__ is a single C call and needs no lock.
+    if getattr(sys, "_is_gil_enabled", lambda: True)():
+        return itertools.count(1)
+    return _LockedCounter()
+
+
+# How many recent idempotent calls a session remembers having written/finished.
+_SESSION_CALL_CACHE_SIZE = 256
+
+
+class _LRUCache:
+    """A small thread-safe map that drops its least recently used entry past maxsize.
+
+    Used for per-session memos whose misses fall back to the database, so
+    evicting an entry only costs a query, never correctness.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self._data: OrderedDict[tuple, Any] = OrderedDict()
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: tuple) -> bool:
+        return self.get(key) is not None
+
+    def get(self, key: tuple) -> Any:
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key: tuple, value: Any) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+
+def _new_call_cache() -> _LRUCache:
+    return _LRUCache(_SESSION_CALL_CACHE_SIZE)
+
+
+def _loads(data: str | bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
 
 def _deserialize_json(output: Any) -> Any:
     return output
 
 
-@dataclass
+def _prior_result(status: str, output_json: Optional[str], error: Optional[str]) -> Any:
+    """Outcome of an already-recorded call: its decoded output, or its error re-raised."""
+    if status == "error":
+        raise RuntimeError(f"Prior attempt failed: {error}")
+    if output_json is None:
+        return None
+    return _deserialize_json(_loads(output_json))
+
+
+def _decode_replay_record(record: dict) -> dict:
+    # Names repeat across a run's records; interning shares one object per name and
+    # lets _replay_step's comparisons against registered (interned) names short-circuit.
+    for key in ("tool_name", "phase", "status"):
+        value = record.get(key)
+        if type(value) is str:
+            record[key] = sys.intern(value)
+    # Parse stored output once at load time rather than on every replayed step.
+    out = record.get("output_json")
+    if isinstance(out, (str, bytes)):
+        try:
+            record["output_json"] = _loads(out)
+        except ValueError:
+            # Exported JSON may already hold a decoded (non-JSON) string.
+            pass
+    return record
+
+
+@dataclass(slots=True)
 class ExecutedStep:
     tool_name: str
     compensation_tool_name: Optional[str]
     args: tuple
     kwargs: dict
+    # Reused by the compensation call so its input isn't serialized and hashed again.
+    input_json: Optional[str] = None
+    idempotency_key: Optional[str] = None
+
+
+@dataclass(slots=True)
+class _CallSpec:
+    # Everything about one tool or LLM call, built once by execute_tool_call or
+    # execute_llm_call and handed down the execution path as is.
+    call_id: str
+    idempotent: bool
+    idem_key: str
+    input_json: str
+    tool_name: str
+    func: ToolCall
+    args: tuple
+    kwargs: dict
+    phase: str
+    compensation_tool_name: Optional[str]
+    parent_tool_call_id: Optional[str]
+    internal: bool
+    provider: Optional[str]
+    model: Optional[str]
+    request_fingerprint: Optional[str]
+    usage_parser: Optional[Callable[[Any], LLMUsage]]
 
 
 @dataclass
@@ -56,11 +435,16 @@ class AgentRuntime:
     db: Database
     tools: Dict[str, ToolCall] = field(default_factory=dict)
     compensations: Dict[str, str] = field(default_factory=dict)
+    # Tools registered with idempotent=False; every call to them is recorded as a new call.
+    non_idempotent_tools: Set[str] = field(default_factory=set)
 
     # How long to wait for a "pending" idempotent tool call claimed by another worker/thread.
     pending_timeout_s: float = 60.0
     pending_poll_interval_s: float = 0.25
 
+    # Terminal tool-call updates are buffered per session and flushed in batches.
+    write_buffer_size: int = 64
+
     @classmethod
     def from_connection_string(cls, conn_str: str) -> "AgentRuntime":
         db = Database.from_connection_string(conn_str)
@@ -71,11 +455,23 @@ class AgentRuntime:
         db = Database.from_env()
         return cls(db=db)
 
-    def register_tool(self, name: str, func: ToolCall) -> None:
+    def close(self) -> None:
+        self.db.close()
+
+    def register_tool(self, name: str, func: ToolCall, *, idempotent: bool = True) -> None:
+        # Interned so per-call registry lookups and replay comparisons hit on identity.
+        name = intern_name(name)
         self.tools[name] = func
+        if idempotent:
+            self.non_idempotent_tools.discard(name)
+        else:
+            self.non_idempotent_tools.add(name)
+
+    def is_idempotent(self, name: str) -> bool:
+        return name not in self.non_idempotent_tools
 
     def register_compensation(self, tool_name: str, compensation_tool_name: str) -> None:
-        self.compensations[tool_name] = compensation_tool_name
+        self.compensations[intern_name(tool_name)] = intern_name(compensation_tool_name)
 
     def get_tool(self, name: str) -> ToolCall:
         return self.tools[name]
@@ -112,40 +508,53 @@ class AgentRuntime:
 
     def export_run(self, run_id: str) -> dict:
         run = self.db.fetchone(
-            """
-            SELECT id, name, status, tags, budget_limit, total_prompt_tokens, total_completion_tokens,
-                   total_tokens, total_cost, input_json, output_json, error, replay_of, created_at, updated_at
-            FROM agent_runs
-            WHERE id = :id
-            """,
+            _SQL_SELECT_RUN_EXPORT,
             {"id": run_id},
         )
         if not run:
             raise ValueError(f"Run not found: {run_id}")
 
         calls = self.db.fetchall(
-            """
-            SELECT id, seq_no, tool_name, idempotency_key, phase, status, parent_tool_call_id, internal,
-                   provider, model, request_fingerprint, prompt_tokens, completion_tokens, total_tokens,
-                   input_cost, output_cost, total_cost, input_json, output_json, error, created_at, updated_at
-            FROM tool_calls
-            WHERE run_id = :run_id
-            ORDER BY seq_no ASC
-            """,
+            _SQL_SELECT_TOOL_CALLS_EXPORT,
             {"run_id": run_id},
         )
 
         return {
-            "run": dict(run._mapping),
-            "tool_calls": [dict(c._mapping) for c in calls],
+            "run": dict(zip(_RUN_EXPORT_COLS, run)),
+            "tool_calls": [dict(zip(_TOOL_CALL_EXPORT_COLS, c)) for c in calls],
         }
 
+    def export_run_columns(self, run_id: str) -> dict:
+        """Like export_run(), but with tool calls as one list per column.
+
+        Cheaper to build and serialize for large runs than a dict per row; meant
+        for analysis and dashboards. replay_exported_json() needs export_run().
+        """
+        run = self.db.fetchone(_SQL_SELECT_RUN_EXPORT, {"id": run_id})
+        if not run:
+            raise ValueError(f"Run not found: {run_id}")
+
+        calls = self.db.fetchall(_SQL_SELECT_TOOL_CALLS_EXPORT, {"run_id": run_id})
+        columns = zip(*calls) if calls else ([] for _ in _TOOL_CALL_EXPORT_COLS)
+        return {
+            "run": dict(zip(_RUN_EXPORT_COLS, run)),
+            "tool_calls": {col: list(values) for col, values in zip(_TOOL_CALL_EXPORT_COLS, columns)},
+        }
+
+    def export_run_iter(self, run_id: str) -> Iterator[dict]:
+        """Yield a run's tool calls in order, streamed from a server-side cursor.
+
+        Use instead of export_run() when a run is too large to hold in memory.
+        """
+        for c in self.db.iter_rows(_SQL_SELECT_TOOL_CALLS_EXPORT, {"run_id": run_id}):
+            yield dict(zip(_TOOL_CALL_EXPORT_COLS, c))
+
     def replay_exported_json(self, exported: dict, agent_fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
         replay_calls = exported.get("tool_calls") or []
         with self.agent_session(
             name="replay_export",
             replay=True,
-            replay_run_id=str(exported.get("run", {}).get("id") or uuid.uuid4()),
+            replay_run_id=str(exported.get("run", {}).get("id") or _new_id()),
             replay_calls=replay_calls,
         ) as session:
             result = agent_fn(*args, **kwargs)
@@ -153,7 +562,7 @@ class AgentRuntime:
             return result
 
 
-@dataclass
+@dataclass(slots=True)
 class AgentSession:
     runtime: AgentRuntime
     name: str
@@ -181,51 +590,60 @@ class AgentSession:
 
     _replay_calls: List[dict] = field(default_factory=list, init=False)
     _replay_index: int = field(default=0, init=False)
-    _seq_lock: threading.Lock = field(default_factory=threading.Lock, init=False)
+    _seq_counter: Iterator[int] = field(default_factory=_new_seq_counter, init=False)
+    _write_lock: threading.Lock = field(default_factory=threading.Lock, init=False)
+    _pending_writes: List[tuple] = field(default_factory=list, init=False)
+    _conn: Optional[SessionConnection] = field(default=None, init=False)
+    # (tool_name, phase, idempotency_key) of calls a thread of this session is running.
+    _inflight: Dict[tuple, threading.Event] = field(default_factory=dict, init=False)
+    # Recent calls whose row this session has seen written; repeating one can only conflict.
+    _claimed: _LRUCache = field(default_factory=_new_call_cache, init=False)
+    # (status, output_json, error) of recent idempotent calls this session ran to
+    # completion, so repeats are answered without flushing and re-reading their row.
+    _finished: _LRUCache = field(default_factory=_new_call_cache, init=False)
 
     def __enter__(self) -> "AgentSession":
-        if self.replay:
-            if not self.replay_run_id:
-                raise ValueError("replay_run_id must be provided for replay sessions")
-            self.run_id = self.replay_run_id
-            if self.replay_calls is not None:
-                self._replay_calls = list(self.replay_calls)
+        if self.replay and not self.replay_run_id:
+            raise ValueError("replay_run_id must be provided for replay sessions")
+
+        self._conn = self.runtime.db.session_connection()
+        try:
+            if self.replay:
+                self.run_id = self.replay_run_id
+                if self.replay_calls is not None:
+                    self._replay_calls = [_decode_replay_record(dict(r)) for r in self.replay_calls]
+                else:
+                    self._load_replay_calls()
             else:
-                self._load_replay_calls()
-            set_current_session(self)
-            return self
-
-        self.run_id = str(uuid.uuid4())
-        now = datetime.utcnow()
-        self.runtime.db.execute(
-            """
-            INSERT INTO agent_runs (
-                id, name, status, tags, budget_limit,
-                total_prompt_tokens, total_completion_tokens, total_tokens, total_cost,
-                input_json, created_at, updated_at
-            ) VALUES (
-                :id, :name, :status, :tags, :budget_limit,
-                :pt, :ct, :tt, :tc,
-                :input_json, :created_at, :updated_at
-            )
-            """,
+                self.run_id = _new_id()
+                self._insert_run()
+        except BaseException:
+            self._close_connection()
+            raise
+        # The agent body runs next; don't hold a pooled connection through it.
+        self._session_conn().release()
+        set_current_session(self)
+        return self
+
+    def _insert_run(self) -> None:
+        now = _utcnow()
+        self._session_conn().execute(
+            _SQL_INSERT_AGENT_RUN,
             {
                 "id": self.run_id,
                 "name": self.name,
                 "status": self.status,
-                "tags": json.dumps(self.tags) if self.tags else None,
+                "tags": _dumps(self.tags) if self.tags else None,
                 "budget_limit": self.budget_limit,
                 "pt": int(self.total_prompt_tokens),
                 "ct": int(self.total_completion_tokens),
                 "tt": int(self.total_tokens),
                 "tc": float(self.total_cost),
-                "input_json": json.dumps(_serialize_json(self.input_payload)),
+                "input_json": _dumps(self.input_payload),
                 "created_at": now,
                 "updated_at": now,
             },
         )
-        set_current_session(self)
-        return self
 
     def __exit__(self, exc_type, exc_value, traceback) -> None:
         try:
@@ -244,55 +662,74 @@ class AgentSession:
 
             self._persist_final_status()
         finally:
+            self._close_connection()
             set_current_session(None)
+        # After releasing ours: maintenance checks out its own pooled connection.
+        self.runtime.db.maybe_checkpoint()
+        self.runtime.db.maybe_optimize()
 
     def set_output(self, value: Any) -> None:
         self.output_payload = value
 
+    def flush(self) -> None:
+        """Commit buffered tool-call results now instead of with the next claim or at exit."""
+        if self._conn is not None:
+            self._flush_writes()
+
+    def _session_conn(self) -> SessionConnection:
+        conn = self._conn
+        if conn is None:
+            raise RuntimeError("AgentSession has no connection; did you use it as a context manager?")
+        return conn
+
+    def _close_connection(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
     def _persist_final_status(self) -> None:
         if not self.run_id:
             return
 
-        self.runtime.db.execute(
-            """
-            UPDATE agent_runs
-            SET status = :status,
-                output_json = :output_json,
-                error = :error,
-                total_prompt_tokens = :pt,
-                total_completion_tokens = :ct,
-                total_tokens = :tt,
-                total_cost = :tc,
-                updated_at = :updated_at
-            WHERE id = :id
-            """,
-            {
-                "id": self.run_id,
-                "status": self.status,
-                "output_json": json.dumps(_serialize_json(self.output_payload)),
-                "error": self.error,
-                "pt": int(self.total_prompt_tokens),
-                "ct": int(self.total_completion_tokens),
-                "tt": int(self.total_tokens),
-                "tc": float(self.total_cost),
-                "updated_at": datetime.utcnow(),
-            },
-        )
+        # Remaining tool-call writes and the run's final row commit together, and
+        # the writes still go out if building the final row fails.
+        with self._write_lock:
+            batches = self._pending_batches()
+            try:
+                batches.append((_SQL_UPDATE_AGENT_RUN_FINAL, [self._final_run_row()]))
+            finally:
+                self._session_conn().execute_batches(batches)
+                self._pending_writes.clear()
+
+    def _final_run_row(self) -> dict:
+        try:
+            output_json = _dumps(self.output_payload)
+        except (TypeError, ValueError) as e:
+            # An output that can't be stored fails the run rather than losing it.
+            output_json = None
+            self.status = "error"
+            self.error = self.error or f"Could not encode session output: {e}"
+        return {
+            "id": self.run_id,
+            "status": self.status,
+            "output_json": output_json,
+            "error": self.error,
+            "pt": int(self.total_prompt_tokens),
+            "ct": int(self.total_completion_tokens),
+            "tt": int(self.total_tokens),
+            "tc": float(self.total_cost),
+            "updated_at": _utcnow(),
+        }
 
     def _load_replay_calls(self) -> None:
         if not self.run_id:
             return
 
-        rows = self.runtime.db.fetchall(
-            """
-            SELECT seq_no, tool_name, phase, input_json, output_json, status, error
-            FROM tool_calls
-            WHERE run_id = :run_id
-            ORDER BY seq_no ASC
-            """,
+        rows = self._session_conn().fetchall(
+            _SQL_SELECT_REPLAY_CALLS,
             {"run_id": self.run_id},
         )
-        self._replay_calls = [dict(r._mapping) for r in rows]
+        self._replay_calls = [_decode_replay_record(dict(r._mapping)) for r in rows]
 
     # ---- core tool execution API used by the decorator ----
 
@@ -312,136 +749,177 @@ class AgentSession:
         request_fingerprint: Optional[str] = None,
         usage_parser: Optional[Callable[[Any], LLMUsage]] = None,
         input_kwargs: Optional[dict] = None,
+        precomputed_input_json: Optional[str] = None,
+        precomputed_idem_key: Optional[str] = None,
     ) -> Any:
-        if not self.run_id:
-            raise RuntimeError("AgentSession has no run_id; did you use it as a context manager?")
-
+        self._check_active()
         if self.replay:
             return self._replay_step(tool_name, phase)
-
-        if phase == "forward" and self._is_budget_exceeded():
-            raise BudgetExceededError(
-                f"Budget cap exceeded: total_cost={self.total_cost} limit={self.budget_limit}"
-            )
+        if phase == "forward":
+            self._check_budget()
 
         logged_kwargs = input_kwargs if input_kwargs is not None else kwargs
-        idem_key = self._compute_idempotency_key(tool_name, args, logged_kwargs, phase)
-
-        with self._seq_lock:
-            next_seq_no = self.seq_no + 1
-
-        call_id = str(uuid.uuid4())
-        now = datetime.utcnow()
-        parent_id = parent_tool_call_id or get_current_tool_call_id()
+        call_id = _new_id()
+        idempotent = precomputed_idem_key is None and self.runtime.is_idempotent(tool_name)
+        if precomputed_idem_key is not None:
+            # A key derived from a forward call's claim (compensations) is unique by
+            # construction and runs once, as the session unwinds. Nothing can race
+            # it, so skip the claim and write one finished row, batched with the rest.
+            idem_key = precomputed_idem_key
+        elif idempotent:
+            idem_key = self._compute_idempotency_key(tool_name, args, logged_kwargs, phase)
+        else:
+            # No dedupe wanted: the call id is unique, so skip hashing the arguments.
+            idem_key = call_id
+        if precomputed_input_json is not None:
+            input_json = precomputed_input_json
+        elif not args and not logged_kwargs:
+            input_json = _EMPTY_CALL_JSON
+        else:
+            input_json = _dumps({"args": args, "kwargs": logged_kwargs})
+        spec = _CallSpec(
+            call_id=call_id,
+            idempotent=idempotent,
+            idem_key=idem_key,
+            input_json=input_json,
+            tool_name=tool_name,
+            func=func,
+            args=args,
+            kwargs=kwargs,
+            phase=phase,
+            compensation_tool_name=compensation_tool_name,
+            parent_tool_call_id=parent_tool_call_id,
+            internal=internal,
+            provider=provider,
+            model=model,
+            request_fingerprint=request_fingerprint,
+            usage_parser=usage_parser,
+        )
+        return self._execute_impl(spec)
+
+    def _execute_impl(self, spec: _CallSpec) -> Any:
+        idempotent = spec.idempotent
+        if idempotent:
+            tool_name, phase, idem_key = spec.tool_name, spec.phase, spec.idem_key
+            call_key = (tool_name, phase, idem_key)
+            finished = self._finished.get(call_key)
+            if finished is not None:
+                return _prior_result(*finished)
+            if call_key in self._claimed:
+                # Repeat of a call this session already wrote: skip the doomed INSERT.
+                return self._wait_for_existing_call(
+                    tool_name, idem_key, phase, self._inflight.get(call_key)
+                )
+            mine = threading.Event()
+            claim = self._inflight.setdefault(call_key, mine)
+            if claim is not mine:
+                # Another thread of this session is running this exact call; wait for it.
+                return self._wait_for_existing_call(tool_name, idem_key, phase, claim)
+
+        # Numbers burned by a lost claim leave gaps; seq_no only has to order calls.
+        next_seq_no = next(self._seq_counter)
+        if not idempotent:
+            # Nothing to claim: the sequence number is ours as soon as we take it.
+            self.seq_no = next_seq_no
 
-        # Try to claim the idempotent call by inserting a "pending" row.
         try:
-            self.runtime.db.execute(
-                """
-                INSERT INTO tool_calls (
-                    id, run_id, seq_no, tool_name, idempotency_key,
-                    phase, status,
-                    parent_tool_call_id, internal,
-                    provider, model, request_fingerprint,
-                    input_json, created_at, updated_at
-                ) VALUES (
-                    :id, :run_id, :seq_no, :tool_name, :idem,
-                    :phase, :status,
-                    :parent_tool_call_id, :internal,
-                    :provider, :model, :request_fingerprint,
-                    :input_json, :created_at, :updated_at
+            return self._run_call(spec, next_seq_no)
+        finally:
+            if idempotent:
+                self._inflight.pop(call_key).set()
+
+    def _run_call(self, spec: _CallSpec, seq_no: int) -> Any:
+        idempotent = spec.idempotent
+        tool_name = spec.tool_name
+        phase = spec.phase
+        idem_key = spec.idem_key
+        now = _utcnow()
+        row = {
+            "id": spec.call_id,
+            "run_id": self.run_id,
+            "seq_no": seq_no,
+            "tool_name": tool_name,
+            "idem": idem_key,
+            "phase": phase,
+            "parent_tool_call_id": spec.parent_tool_call_id or get_current_tool_call_id(),
+            "internal": 1 if spec.internal else 0,
+            "provider": spec.provider,
+            "model": spec.model,
+            "request_fingerprint": spec.request_fingerprint,
+            "input_json": spec.input_json,
+            "created_at": now,
+        }
+
+        if idempotent:
+            # Try to claim the idempotent call by inserting a "pending" row. Buffered
+            # terminal writes ride along so the claim doesn't cost a commit of its own.
+            with self._write_lock:
+                claimed = self._session_conn().insert_unique(
+                    _SQL_INSERT_TOOL_CALL,
+                    {**row, "status": "pending", "updated_at": now},
+                    self._pending_batches(),
                 )
-                """,
-                {
-                    "id": call_id,
-                    "run_id": self.run_id,
-                    "seq_no": next_seq_no,
-                    "tool_name": tool_name,
-                    "idem": idem_key,
-                    "phase": phase,
-                    "status": "pending",
-                    "parent_tool_call_id": parent_id,
-                    "internal": 1 if internal else 0,
-                    "provider": provider,
-                    "model": model,
-                    "request_fingerprint": request_fingerprint,
-                    "input_json": json.dumps(_serialize_json({"args": args, "kwargs": logged_kwargs})),
-                    "created_at": now,
-                    "updated_at": now,
-                },
-            )
+                self._pending_writes.clear()
+            # Claimed or not, the row exists now.
+            self._claimed.put((tool_name, phase, idem_key), True)
+            if not claimed:
+                # Already recorded earlier in this run, or claimed by another process.
+                return self._wait_for_existing_call(tool_name, idem_key, phase)
             # Only advance sequence if we actually claimed.
-            with self._seq_lock:
-                self.seq_no = next_seq_no
-        except IntegrityError:
-            # Another worker/thread already claimed this same idempotent call.
-            return self._wait_for_existing_call(tool_name, idem_key, phase)
+            self.seq_no = seq_no
 
         if phase == "forward":
             self.executed_steps.append(
                 ExecutedStep(
                     tool_name=tool_name,
-                    compensation_tool_name=compensation_tool_name,
-                    args=args,
-                    kwargs=kwargs,
+                    compensation_tool_name=spec.compensation_tool_name,
+                    args=spec.args,
+                    kwargs=spec.kwargs,
+                    input_json=spec.input_json,
+                    idempotency_key=idem_key,
                 )
             )
 
-        token = set_current_tool_call_id(call_id)
+        # Tools and LLM calls can run for minutes; hand the connection back meanwhile.
+        self._session_conn().release()
+        token = set_current_tool_call_id(spec.call_id)
         try:
-            output = func(*args, **kwargs)
+            output = spec.func(*spec.args, **spec.kwargs)
+            usage_parser = spec.usage_parser
             usage: Optional[LLMUsage] = usage_parser(output) if usage_parser else None
-
-            self.runtime.db.execute(
-                """
-                UPDATE tool_calls
-                SET status = 'success',
-                    output_json = :output_json,
-                    prompt_tokens = :prompt_tokens,
-                    completion_tokens = :completion_tokens,
-                    total_tokens = :total_tokens,
-                    input_cost = :input_cost,
-                    output_cost = :output_cost,
-                    total_cost = :total_cost,
-                    updated_at = :updated_at
-                WHERE id = :id
-                """,
-                {
-                    "id": call_id,
-                    "output_json": json.dumps(_serialize_json(output)),
-                    "prompt_tokens": getattr(usage, "prompt_tokens", None),
-                    "completion_tokens": getattr(usage, "completion_tokens", None),
-                    "total_tokens": getattr(usage, "total_tokens", None),
-                    "input_cost": getattr(usage, "input_cost", None),
-                    "output_cost": getattr(usage, "output_cost", None),
-                    "total_cost": getattr(usage, "total_cost", None),
-                    "updated_at": datetime.utcnow(),
-                },
-            )
-
-            if usage is not None:
-                self._record_usage_totals(usage)
-
-            return output
+            # Encoded here so an output that can't be stored is recorded as an error.
+            result = {
+                "status": "success",
+                "output_json": _dumps(output),
+                **_usage_bind(usage),
+                "error": None,
+            }
         except Exception as e:
-            self.runtime.db.execute(
-                """
-                UPDATE tool_calls
-                SET status = 'error',
-                    error = :error,
-                    updated_at = :updated_at
-                WHERE id = :id
-                """,
-                {
-                    "id": call_id,
-                    "error": str(e),
-                    "updated_at": datetime.utcnow(),
-                },
-            )
+            self._finish_call(row, idempotent, {**_NO_RESULT, "status": "error", "error": str(e)})
             raise
         finally:
             reset_current_tool_call_id(token)
 
+        self._finish_call(row, idempotent, result)
+
+        # Outside the try: going over budget fails the session, not this call,
+        # which has already been recorded as finished.
+        if usage is not None:
+            self._record_usage_totals(usage)
+
+        return output
+
+    def _finish_call(self, row: dict, idempotent: bool, result: dict) -> None:
+        result["updated_at"] = _utcnow()
+        if idempotent:
+            self._buffer_write(_SQL_UPDATE_TOOL_CALL_FINISHED, {"id": row["id"], **result})
+            self._finished.put(
+                (row["tool_name"], row["phase"], row["idem"]),
+                (result["status"], result["output_json"], result["error"]),
+            )
+        else:
+            self._buffer_write(_SQL_INSERT_TOOL_CALL_FINISHED, {**row, **result})
+
     def execute_llm_call(
         self,
         *,
@@ -452,10 +930,21 @@ class AgentSession:
         usage_parser: Callable[[Any], LLMUsage],
         request_fingerprint: Optional[str] = None,
     ) -> Any:
-        logged_kwargs = {"request_fingerprint": request_fingerprint}
-        return self.execute_tool_call(
+        self._check_active()
+        if self.replay:
+            return self._replay_step(tool_name, "forward")
+        self._check_budget()
+
+        # The fingerprint already identifies the request, so it is the key as is.
+        # Without one there is nothing to dedupe on and every call is recorded.
+        call_id = _new_id()
+        spec = _CallSpec(
+            call_id=call_id,
+            idempotent=request_fingerprint is not None,
+            idem_key=request_fingerprint or call_id,
+            input_json=_dumps({"args": [], "kwargs": {"request_fingerprint": request_fingerprint}}),
             tool_name=tool_name,
-            func=lambda: call(),
+            func=call,
             args=(),
             kwargs={},
             phase="forward",
@@ -466,21 +955,42 @@ class AgentSession:
             model=model,
             request_fingerprint=request_fingerprint,
             usage_parser=usage_parser,
-            input_kwargs=logged_kwargs,
         )
+        return self._execute_impl(spec)
 
-    def _wait_for_existing_call(self, tool_name: str, idem_key: str, phase: str) -> Any:
-        deadline = time.time() + float(self.runtime.pending_timeout_s)
+    def _check_active(self) -> None:
+        if not self.run_id:
+            raise RuntimeError("AgentSession has no run_id; did you use it as a context manager?")
+
+    def _check_budget(self) -> None:
+        if self._is_budget_exceeded():
+            raise BudgetExceededError(
+                f"Budget cap exceeded: total_cost={self.total_cost} limit={self.budget_limit}"
+            )
+
+    def _wait_for_existing_call(
+        self,
+        tool_name: str,
+        idem_key: str,
+        phase: str,
+        claim: Optional[threading.Event] = None,
+    ) -> Any:
+        conn = self._session_conn()
+        # One budget for the whole wait, event and polling alike.
+        timeout = float(self.runtime.pending_timeout_s)
+        deadline = time.monotonic() + timeout
+        if claim is not None:
+            # Claimed in-process: block until the owner finishes instead of polling the DB.
+            conn.release()
+            claim.wait(timeout)
+            finished = self._finished.get((tool_name, phase, idem_key))
+            if finished is not None:
+                return _prior_result(*finished)
         while True:
-            row = self.runtime.db.fetchone(
-                """
-                SELECT status, output_json, error
-                FROM tool_calls
-                WHERE run_id = :run_id
-                  AND tool_name = :tool_name
-                  AND idempotency_key = :idem
-                  AND phase = :phase
-                """,
+            # The claiming thread may have buffered its terminal update meanwhile.
+            self._flush_writes()
+            row = conn.fetchone(
+                _SQL_SELECT_EXISTING_CALL,
                 {
                     "run_id": self.run_id,
                     "tool_name": tool_name,
@@ -492,36 +1002,49 @@ class AgentSession:
             if not row:
                 raise RuntimeError("Idempotent call exists but row could not be loaded")
 
-            if row.status == "success":
-                if row.output_json is None:
-                    return None
-                return _deserialize_json(json.loads(row.output_json))
+            if row.status != "pending":
+                return _prior_result(row.status, row.output_json, row.error)
 
-            if row.status == "error":
-                raise RuntimeError(f"Prior attempt failed: {row.error}")
-
-            # pending
-            if time.time() > deadline:
+            if time.monotonic() > deadline:
                 raise TimeoutError(
                     f"Timed out waiting for pending tool call: {tool_name}/{phase}"
                 )
 
+            conn.release()
             time.sleep(float(self.runtime.pending_poll_interval_s))
 
+    def _buffer_write(self, sql: TextClause, params: dict) -> None:
+        with self._write_lock:
+            self._pending_writes.append((sql, params))
+            should_flush = len(self._pending_writes) >= self.runtime.write_buffer_size
+        if should_flush:
+            self._flush_writes()
+
+    def _flush_writes(self) -> None:
+        with self._write_lock:
+            if self._pending_writes:
+                self._session_conn().execute_batches(self._pending_batches())
+                self._pending_writes.clear()
+
+    def _pending_batches(self) -> List[tuple]:
+        # Caller holds _write_lock, and clears _pending_writes only once the
+        # transaction carrying these batches has committed: if it fails, the
+        # writes stay buffered for the next one. Consecutive writes of the same
+        # statement go out as one executemany(), and the batch list commits once.
+        return [
+            (sql, [params for _, params in group])
+            for sql, group in itertools.groupby(self._pending_writes, key=first)
+        ]
+
     def _compute_idempotency_key(self, tool_name: str, args: tuple, kwargs: dict, phase: str) -> str:
-        payload = {"tool": tool_name, "phase": phase, "args": args, "kwargs": kwargs}
-        json_str = json.dumps(payload, sort_keys=True, default=repr)
-        return hashlib.sha256(json_str.encode("utf-8")).hexdigest()
+        return compute_idempotency_key(tool_name, phase, args, kwargs)
 
     def _record_usage_totals(self, usage: LLMUsage) -> None:
         self.total_prompt_tokens += int(usage.prompt_tokens)
         self.total_completion_tokens += int(usage.completion_tokens)
         self.total_tokens += int(usage.total_tokens)
         self.total_cost = round(float(self.total_cost) + float(usage.total_cost), 6)
-        if self._is_budget_exceeded():
-            raise BudgetExceededError(
-                f"Budget cap exceeded: total_cost={self.total_cost} limit={self.budget_limit}"
-            )
+        self._check_budget()
 
     def _is_budget_exceeded(self) -> bool:
         if self.budget_limit is None:
@@ -543,15 +1066,7 @@ class AgentSession:
         if record.get("status") != "success":
             raise RuntimeError(f"Replayed tool call ended in status {record.get('status')}")
 
-        out = record.get("output_json")
-        if out is None:
-            return None
-
-        # If exported JSON already contains decoded objects, accept them.
-        if isinstance(out, (dict, list, str, int, float, bool)):
-            return _deserialize_json(out)
-
-        return _deserialize_json(json.loads(out))
+        return _deserialize_json(record.get("output_json"))
 
     def _run_compensations(self) -> None:
         for step in reversed(self.executed_steps):
@@ -559,6 +1074,14 @@ class AgentSession:
                 continue
             try:
                 comp_fn = self.runtime.get_tool(step.compensation_tool_name)
+                # A step built without its forward key falls back to hashing the arguments.
+                comp_key = (
+                    derive_idempotency_key(
+                        step.idempotency_key, step.compensation_tool_name, "compensation"
+                    )
+                    if step.idempotency_key is not None
+                    else None
+                )
                 self.execute_tool_call(
                     tool_name=step.compensation_tool_name,
                     func=comp_fn,
@@ -566,6 +1089,8 @@ class AgentSession:
                     kwargs=step.kwargs,
                     phase="compensation",
                     compensation_tool_name=None,
+                    precomputed_input_json=step.input_json,
+                    precomputed_idem_key=comp_key,
                 )
             except Exception:
                 # Best-effort: compensation failures shouldn't mask the original error.
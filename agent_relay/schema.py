@@ -3,6 +3,9 @@ from __future__ import annotations
 # OSS/local runtime uses SQLite (default) or MySQL.
 # The cloud backend often uses Postgres.
 
+# Bump whenever any SCHEMA_SQL_* changes so existing databases re-run the DDL.
+SCHEMA_VERSION = 2
+
 SCHEMA_SQL_POSTGRES = """
 CREATE TABLE IF NOT EXISTS agent_runs (
     id UUID PRIMARY KEY,
@@ -54,6 +57,12 @@ CREATE TABLE IF NOT EXISTS tool_calls (
 
 CREATE INDEX IF NOT EXISTS idx_tool_calls_run_seq ON tool_calls (run_id, seq_no);
 CREATE INDEX IF NOT EXISTS idx_tool_calls_parent ON tool_calls (parent_tool_call_id);
+
+-- Containment lookups (col @> '{"k": "v"}'::jsonb). jsonb_path_ops only serves @>,
+-- at roughly half the size of the default GIN opclass.
+CREATE INDEX IF NOT EXISTS idx_agent_runs_tags_gin ON agent_runs USING GIN (tags jsonb_path_ops);
+CREATE INDEX IF NOT EXISTS idx_tool_calls_input_gin ON tool_calls USING GIN (input_json jsonb_path_ops);
+CREATE INDEX IF NOT EXISTS idx_tool_calls_output_gin ON tool_calls USING GIN (output_json jsonb_path_ops);
 """
 
 SCHEMA_SQL_SQLITE = """
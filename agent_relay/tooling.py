@@ -4,18 +4,27 @@ from functools import wraps
 from typing import Any, Callable, Optional
 from .context import get_current_session
 from .runtime import AgentRuntime
+from .util import intern_name
 
 ToolCall = Callable[..., Any]
 def tool(
     runtime: AgentRuntime,
     name: Optional[str] = None,
     compensation: Optional[str] = None,
+    idempotent: bool = True,
 ) -> Callable[[ToolCall], ToolCall]:
     def decorator(func: ToolCall) -> ToolCall:
-        tool_name = name or func.__name__
+        # Re-decorating (hot reload, registering on a second runtime) wraps the
+        # original function again rather than stacking wrappers. Only our own
+        # wrapper is unwrapped: functools.wraps copies the marker onto any other
+        # decorator stacked on a tool, and those must stay in the chain.
+        inner: Optional[ToolCall] = getattr(func, "__agentrelay_tool__", None)
+        if getattr(func, "__wrapped__", None) is inner and inner is not None:
+            func = inner
+        tool_name = intern_name(name or func.__name__)
 
         # Register the forward tool
-        runtime.register_tool(tool_name, func)
+        runtime.register_tool(tool_name, func, idempotent=idempotent)
 
         # Optionally register the compensation mapping
         if compensation:
@@ -45,6 +54,7 @@ def tool(
                 compensation_tool_name=compensation_name,
             )
 
+        wrapper.__agentrelay_tool__ = func  # type: ignore[attr-defined]
         return wrapper  # type: ignore[return-value]
 
     return decorator
\ No newline at end of file
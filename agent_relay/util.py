@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+import sys
+from operator import itemgetter
+from typing import Any, Callable, Optional, Sequence
+
+first = itemgetter(0)
+
+# Pushed, after a container's id, below the container's children; popping it
+# means every child has been visited.
+_LEAVE = object()
+
+
+def intern_name(name: str) -> str:
+    # sys.intern() only takes an exact str; subclasses (e.g. str enums) are kept as given.
+    return sys.intern(name) if type(name) is str else name
+
+
+def walk(root: Any, visit: Callable[[Any], Optional[tuple[Any, Sequence[Any]]]]) -> None:
+    """Visit a nested payload depth-first and in order, with an explicit stack.
+
+    visit(node) handles one node; for a container it returns (container, children)
+    and the children are visited next. Deep nesting can't hit the recursion limit,
+    and a container that contains itself raises ValueError, as json.dumps() does.
+    """
+    stack: list[Any] = [root]
+    on_path: set[int] = set()
+    while stack:
+        node = stack.pop()
+        if node is _LEAVE:
+            on_path.discard(stack.pop())
+            continue
+        expanded = visit(node)
+        if expanded is None:
+            continue
+        container, children = expanded
+        container_id = id(container)
+        if container_id in on_path:
+            raise ValueError("Circular reference detected")
+        on_path.add(container_id)
+        stack.append(container_id)
+        stack.append(_LEAVE)
+        stack.extend(reversed(children))
@@ -0,0 +1,178 @@
+import sqlite3
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+
+from agent_relay.db import Database, _is_sqlite_memory
+
+
+def _file_db(tmp_path):
+    return Database.from_connection_string(f"sqlite+pysqlite:///{tmp_path / 'agenttrail.db'}")
+
+
+@pytest.fixture
+def db(tmp_path):
+    database = _file_db(tmp_path)
+    yield database
+    database.close()
+
+
+@pytest.mark.parametrize(
+    "url, memory",
+    [
+        ("sqlite://", True),
+        ("sqlite+pysqlite:///:memory:", True),
+        ("sqlite:///file::memory:?cache=shared&uri=true", True),
+        ("sqlite:///file:scratch?mode=memory&cache=shared&uri=true", True),
+        ("sqlite+pysqlite:///./agenttrail.db", False),
+        ("sqlite:///file:agenttrail.db?mode=rwc&uri=true", False),
+    ],
+)
+def test_is_sqlite_memory(url, memory):
+    assert _is_sqlite_memory(make_url(url)) is memory
+
+
+def test_memory_uri_database_skips_file_pragmas_and_pool_limits(monkeypatch):
+    monkeypatch.setenv("AGENTTRAIL_DB_POOL_SIZE", "2")
+    monkeypatch.setenv("AGENTTRAIL_DB_MAX_OVERFLOW", "0")
+    db = Database.from_connection_string("sqlite:///file:scratch?mode=memory&cache=shared&uri=true")
+    try:
+        with db.engine.connect() as conn:
+            assert conn.execute(text("PRAGMA journal_mode")).scalar() == "memory"
+    finally:
+        db.close()
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT id, name FROM agent_runs WHERE name != :skip ORDER BY id",
+    text("SELECT id, name FROM agent_runs WHERE name != :skip ORDER BY id"),
+])
+def test_iter_rows_streams_every_row_across_batches(db, sql):
+    now = "2026-01-01T00:00:00"
+    with db.engine.begin() as conn:
+        for i in range(7):
+            conn.execute(
+                text(
+                    "INSERT INTO agent_runs (id, name, status, created_at, updated_at)"
+                    " VALUES (:id, :name, 'success', :now, :now)"
+                ),
+                {"id": f"run-{i}", "name": "skip" if i == 3 else f"n{i}", "now": now},
+            )
+
+    rows = db.iter_rows(sql, {"skip": "skip"}, batch_size=2)
+    assert [tuple(r) for r in rows] == [(f"run-{i}", f"n{i}") for i in range(7) if i != 3]
+
+
+def _write_runs(db, count):
+    with db.engine.begin() as conn:
+        for i in range(count):
+            conn.execute(
+                text(
+                    "INSERT INTO agent_runs (id, name, status, created_at, updated_at)"
+                    " VALUES (:id, 'n', 'success', :now, :now)"
+                ),
+                {"id": f"run-{i}", "now": "2026-01-01T00:00:00"},
+            )
+
+
+def test_close_truncates_the_wal_and_can_be_repeated(tmp_path):
+    path = tmp_path / "agenttrail.db"
+    db = Database.from_connection_string(f"sqlite+pysqlite:///{path}")
+    _write_runs(db, 50)
+    wal = tmp_path / "agenttrail.db-wal"
+    # Another process still has the file open, so closing ours won't delete the WAL.
+    other = sqlite3.connect(path)
+    try:
+        other.execute("SELECT 1 FROM agent_runs LIMIT 1").fetchall()
+        assert wal.stat().st_size > 0
+
+        db.close()
+        assert wal.stat().st_size == 0
+        db.close()
+    finally:
+        other.close()
+
+    reopened = Database.from_connection_string(f"sqlite+pysqlite:///{path}")
+    try:
+        with reopened.engine.connect() as conn:
+            assert conn.execute(text("SELECT COUNT(*) FROM agent_runs")).scalar() == 50
+    finally:
+        reopened.close()
+
+
+def test_maybe_checkpoint_runs_at_most_once_per_interval(db, monkeypatch):
+    modes = []
+    monkeypatch.setattr(db, "_checkpoint", modes.append)
+    db.maybe_checkpoint()
+    assert modes == []
+
+    db._last_checkpoint -= 60
+    db.maybe_checkpoint()
+    db.maybe_checkpoint()
+    assert modes == ["PASSIVE"]
+
+
+def test_pool_size_env_overrides_apply_to_file_databases(tmp_path, monkeypatch):
+    monkeypatch.setenv("AGENTTRAIL_DB_POOL_SIZE", "3")
+    monkeypatch.setenv("AGENTTRAIL_DB_MAX_OVERFLOW", "0")
+    db = _file_db(tmp_path)
+    try:
+        assert db.engine.pool.size() == 3
+        assert db.engine.pool._max_overflow == 0
+    finally:
+        db.close()
+
+
+@pytest.mark.parametrize("value", ["many", "-1"])
+def test_invalid_pool_size_env_raises(tmp_path, monkeypatch, value):
+    monkeypatch.setenv("AGENTTRAIL_DB_POOL_SIZE", value)
+    with pytest.raises(ValueError, match="AGENTTRAIL_DB_POOL_SIZE"):
+        _file_db(tmp_path)
+
+
+@pytest.mark.parametrize("value, pre_ping", [(None, False), ("1", True), ("off", False), (" ", False)])
+def test_pre_ping_env_override(tmp_path, monkeypatch, value, pre_ping):
+    if value is None:
+        monkeypatch.delenv("AGENTTRAIL_DB_POOL_PRE_PING", raising=False)
+    else:
+        monkeypatch.setenv("AGENTTRAIL_DB_POOL_PRE_PING", value)
+    db = _file_db(tmp_path)
+    try:
+        assert db.engine.pool._pre_ping is pre_ping
+    finally:
+        db.close()
+
+
+@pytest.mark.parametrize("value, level", [(None, 1), ("FULL", 2), ("off", 0)])
+def test_sqlite_synchronous_env_override(tmp_path, monkeypatch, value, level):
+    if value is None:
+        monkeypatch.delenv("AGENTTRAIL_SQLITE_SYNCHRONOUS", raising=False)
+    else:
+        monkeypatch.setenv("AGENTTRAIL_SQLITE_SYNCHRONOUS", value)
+    db = _file_db(tmp_path)
+    try:
+        with db.engine.connect() as conn:
+            assert conn.execute(text("PRAGMA synchronous")).scalar() == level
+    finally:
+        db.close()
+
+
+def test_invalid_sqlite_synchronous_env_raises(tmp_path, monkeypatch):
+    monkeypatch.setenv("AGENTTRAIL_SQLITE_SYNCHRONOUS", "sometimes")
+    with pytest.raises(ValueError, match="AGENTTRAIL_SQLITE_SYNCHRONOUS"):
+        _file_db(tmp_path)
+
+
+@pytest.mark.parametrize("memory", [True, False])
+def test_connection_pragmas_skip_file_only_settings_in_memory(tmp_path, memory):
+    url = "sqlite+pysqlite:///:memory:" if memory else f"sqlite+pysqlite:///{tmp_path / 'agenttrail.db'}"
+    db = Database.from_connection_string(url)
+    try:
+        with db.engine.connect() as conn:
+            assert conn.execute(text("PRAGMA journal_mode")).scalar() == ("memory" if memory else "wal")
+            # The rest still apply.
+            assert conn.execute(text("PRAGMA cache_size")).scalar() == -65536
+            assert conn.execute(text("PRAGMA foreign_keys")).scalar() == 1
+    finally:
+        db.close()
@@ -0,0 +1,73 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from agent_relay import idempotency
+from agent_relay.idempotency import compute_idempotency_key, derive_idempotency_key
+
+
+@pytest.fixture
+def hash_env(monkeypatch):
+    def use(name):
+        monkeypatch.setenv("AGENTTRAIL_IDEMPOTENCY_HASH", name)
+        # The hasher is resolved once per process; drop it so the setting is read again.
+        monkeypatch.setattr(idempotency, "_hasher_factory", None)
+
+    return use
+
+
+def test_shared_container_is_not_a_cycle():
+    shared = {"id": 1}
+    assert compute_idempotency_key("t", "forward", (shared, shared), {}) == compute_idempotency_key(
+        "t", "forward", ({"id": 1}, {"id": 1}), {}
+    )
+
+
+@pytest.mark.parametrize("make_cycle", [lambda v: v.append(v), lambda v: v.append({"parent": v})])
+def test_cyclic_args_raise(make_cycle):
+    value = []
+    make_cycle(value)
+    with pytest.raises(ValueError, match="Circular reference"):
+        compute_idempotency_key("t", "forward", (value,), {})
+
+
+def test_blake3_keys_differ_from_sha256(hash_env):
+    blake3 = pytest.importorskip("blake3")
+    hash_env("sha256")
+    sha256_key = compute_idempotency_key("t", "forward", (1,), {"a": "b"})
+    hash_env("blake3")
+    key = compute_idempotency_key("t", "forward", (1,), {"a": "b"})
+
+    assert idempotency._hasher_factory is blake3.blake3
+    assert len(key) == 64
+    assert key != sha256_key
+    assert key == compute_idempotency_key("t", "forward", (1,), {"a": "b"})
+
+
+def test_unsupported_hash_fails_on_first_key_not_import(hash_env):
+    env = {**os.environ, "AGENTTRAIL_IDEMPOTENCY_HASH": "md5"}
+    subprocess.run([sys.executable, "-c", "import agent_relay"], env=env, check=True)
+
+    hash_env("md5")
+    with pytest.raises(ValueError, match="AGENTTRAIL_IDEMPOTENCY_HASH"):
+        compute_idempotency_key("t", "forward", (), {})
+
+
+def test_derived_key_is_stable_and_tied_to_its_parent():
+    parent = compute_idempotency_key("reserve", "forward", ("seat",), {})
+    key = derive_idempotency_key(parent, "release", "compensation")
+
+    assert key == derive_idempotency_key(parent, "release", "compensation")
+    assert len(key) == 64
+    other_parent = compute_idempotency_key("reserve", "forward", ("bed",), {})
+    assert len({
+        key,
+        parent,
+        derive_idempotency_key(other_parent, "release", "compensation"),
+        derive_idempotency_key(parent, "cancel", "compensation"),
+        derive_idempotency_key(parent, "release", "forward"),
+        # Not the key the compensation's own arguments would hash to.
+        compute_idempotency_key("release", "compensation", ("seat",), {}),
+    }) == 6
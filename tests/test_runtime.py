@@ -0,0 +1,311 @@
+import contextvars
+import json
+import threading
+import time
+from enum import Enum
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from agent_relay.db import SessionConnection
+from agent_relay.idempotency import derive_idempotency_key
+from agent_relay.llm import wrap_openai_call
+from agent_relay.runtime import AgentRuntime, BudgetExceededError
+from agent_relay.tooling import tool
+
+
+@pytest.fixture
+def runtime(tmp_path):
+    rt = AgentRuntime.from_connection_string(f"sqlite+pysqlite:///{tmp_path / 'agenttrail.db'}")
+    yield rt
+    rt.close()
+
+
+def _locked(*args, **kwargs):
+    raise OperationalError("COMMIT", {}, Exception("database is locked"))
+
+
+def _calls(runtime, run_id):
+    return [
+        (c["tool_name"], c["phase"], c["status"])
+        for c in runtime.export_run(run_id)["tool_calls"]
+    ]
+
+
+def test_budget_exceeded_after_non_idempotent_llm_call(runtime):
+    released = []
+
+    @tool(runtime, name="reserve", compensation="release")
+    def reserve(item):
+        return item
+
+    @tool(runtime, name="release")
+    def release(item):
+        released.append(item)
+
+    def completion():
+        return {"usage": {"prompt_tokens": 1000, "completion_tokens": 1000}}
+
+    with pytest.raises(BudgetExceededError):
+        with runtime.agent_session(name="budget", budget_limit=0.5) as session:
+            reserve("seat")
+            # No request_payload: recorded as a non-idempotent call.
+            wrap_openai_call(
+                model="m", call=completion, input_cost_per_1k=0.3, output_cost_per_1k=0.3
+            )
+
+    assert released == ["seat"]
+    exported = runtime.export_run(session.run_id)
+    assert exported["run"]["status"] == "error"
+    assert exported["run"]["total_cost"] == pytest.approx(0.6)
+    assert _calls(runtime, session.run_id) == [
+        ("reserve", "forward", "success"),
+        ("llm.openai", "forward", "success"),
+        ("release", "compensation", "success"),
+    ]
+
+
+def test_compensation_key_is_derived_from_the_forward_key(runtime):
+    @tool(runtime, name="reserve", compensation="release")
+    def reserve(item):
+        return item
+
+    @tool(runtime, name="release")
+    def release(item):
+        pass
+
+    with pytest.raises(KeyError):
+        with runtime.agent_session(name="unwind") as session:
+            reserve("seat")
+            raise KeyError("boom")
+
+    forward, compensation = runtime.export_run(session.run_id)["tool_calls"]
+    assert compensation["phase"] == "compensation"
+    assert compensation["idempotency_key"] == derive_idempotency_key(
+        forward["idempotency_key"], "release", "compensation"
+    )
+
+
+def test_cyclic_input_raises_for_non_idempotent_tool(runtime):
+    logged = []
+
+    @tool(runtime, name="log", idempotent=False)
+    def log(entry):
+        logged.append(entry)
+
+    shared = [1, 2]
+    entry = {"items": [shared, shared]}
+    entry["self"] = entry
+    with pytest.raises(ValueError, match="Circular reference"):
+        with runtime.agent_session(name="cyclic"):
+            log({"items": [shared, shared]})
+            log(entry)
+
+    assert len(logged) == 1
+
+
+@pytest.mark.parametrize("idempotent", [True, False])
+def test_unencodable_output_is_recorded_as_error(runtime, idempotent):
+    ran = []
+
+    @tool(runtime, name="build", idempotent=idempotent)
+    def build():
+        ran.append(1)
+        node = {}
+        node["self"] = node
+        return node
+
+    with runtime.agent_session(name="unencodable") as session:
+        with pytest.raises(ValueError, match="Circular reference"):
+            build()
+        if idempotent:
+            # The repeat sees the recorded failure instead of waiting on a pending claim.
+            with pytest.raises(RuntimeError, match="Prior attempt failed"):
+                build()
+
+    assert ran == [1]
+    assert _calls(runtime, session.run_id) == [("build", "forward", "error")]
+
+
+def test_unencodable_session_output_fails_the_run_but_keeps_its_calls(runtime):
+    @tool(runtime, name="fetch")
+    def fetch(key):
+        return key
+
+    output = {}
+    output["self"] = output
+    with runtime.agent_session(name="bad-output") as session:
+        fetch("a")
+        session.set_output(output)
+
+    run = runtime.export_run(session.run_id)["run"]
+    assert run["status"] == "error"
+    assert "Circular reference" in run["error"]
+    assert _calls(runtime, session.run_id) == [("fetch", "forward", "success")]
+
+
+def test_failed_claim_keeps_buffered_writes(runtime, monkeypatch):
+    @tool(runtime, name="fetch")
+    def fetch(key):
+        return key.upper()
+
+    insert_unique = SessionConnection.insert_unique
+    with runtime.agent_session(name="flaky") as session:
+        assert fetch("a") == "A"
+        # The claim for "b" carries fetch("a")'s buffered result and fails.
+        monkeypatch.setattr(SessionConnection, "insert_unique", _locked)
+        with pytest.raises(OperationalError):
+            fetch("b")
+        monkeypatch.setattr(SessionConnection, "insert_unique", insert_unique)
+        assert fetch("c") == "C"
+
+    assert _calls(runtime, session.run_id) == [
+        ("fetch", "forward", "success"),
+        ("fetch", "forward", "success"),
+    ]
+
+
+def test_failed_flush_keeps_buffered_writes(runtime, monkeypatch):
+    @tool(runtime, name="fetch")
+    def fetch(key):
+        return key.upper()
+
+    execute_batches = SessionConnection.execute_batches
+    with runtime.agent_session(name="flaky") as session:
+        fetch("a")
+        monkeypatch.setattr(SessionConnection, "execute_batches", _locked)
+        with pytest.raises(OperationalError):
+            session.flush()
+        monkeypatch.setattr(SessionConnection, "execute_batches", execute_batches)
+
+    assert runtime.export_run(session.run_id)["run"]["status"] == "success"
+    assert _calls(runtime, session.run_id) == [("fetch", "forward", "success")]
+
+
+class ToolName(str, Enum):
+    FETCH = "fetch"
+    UNFETCH = "unfetch"
+
+
+def test_tool_names_may_be_str_subclasses(runtime):
+    @tool(runtime, name=ToolName.FETCH, compensation=ToolName.UNFETCH)
+    def fetch(key):
+        return key.upper()
+
+    with runtime.agent_session(name="enum") as session:
+        assert fetch("a") == "A"
+        assert fetch("a") == "A"
+
+    assert _calls(runtime, session.run_id) == [("fetch", "forward", "success")]
+
+
+def test_repeat_after_eviction_still_returns_recorded_result(runtime, monkeypatch):
+    monkeypatch.setattr("agent_relay.runtime._SESSION_CALL_CACHE_SIZE", 2)
+    ran = []
+
+    @tool(runtime, name="fetch")
+    def fetch(key):
+        ran.append(key)
+        return {"key": key}
+
+    with runtime.agent_session(name="evict") as session:
+        for key in "abc":
+            fetch(key)
+        assert len(session._finished) == 2
+        # "a" has been evicted, so the repeat is resolved against its stored row.
+        assert fetch("a") == {"key": "a"}
+
+    assert ran == ["a", "b", "c"]
+
+
+def test_buffered_results_flush_when_full_and_on_flush(runtime):
+    runtime.write_buffer_size = 2
+
+    @tool(runtime, name="tick", idempotent=False)
+    def tick():
+        return 1
+
+    @tool(runtime, name="fetch")
+    def fetch(key):
+        return key
+
+    with runtime.agent_session(name="buffer") as session:
+        tick()
+        assert _calls(runtime, session.run_id) == []
+        tick()
+        assert _calls(runtime, session.run_id) == [("tick", "forward", "success")] * 2
+        fetch("a")
+        assert _calls(runtime, session.run_id)[-1] == ("fetch", "forward", "pending")
+        session.flush()
+        assert _calls(runtime, session.run_id)[-1] == ("fetch", "forward", "success")
+
+
+def test_duplicate_claim_commits_pending_batches(runtime, monkeypatch):
+    # No in-session memo: the repeat has to go through the claim INSERT and lose.
+    monkeypatch.setattr("agent_relay.runtime._SESSION_CALL_CACHE_SIZE", 0)
+    ran = []
+
+    @tool(runtime, name="fetch")
+    def fetch(key):
+        ran.append(key)
+        return key.upper()
+
+    with runtime.agent_session(name="dup") as session:
+        assert fetch("a") == "A"
+        # fetch("a")'s result is still buffered and rides along with the failed claim.
+        assert fetch("a") == "A"
+        assert _calls(runtime, session.run_id) == [("fetch", "forward", "success")]
+
+    assert ran == ["a"]
+
+
+@pytest.mark.parametrize("output", ["plain text", "42", {"nested": {"ok": True}}, ["x", 1], None])
+def test_replay_returns_stored_output(runtime, output):
+    @tool(runtime, name="produce")
+    def produce():
+        return output
+
+    with runtime.agent_session(name="original") as session:
+        produce()
+
+    assert runtime.replay_run(session.run_id, produce) == output
+    exported = json.loads(json.dumps(runtime.export_run(session.run_id), default=str))
+    assert runtime.replay_exported_json(exported, produce) == output
+
+
+def test_in_process_waiter_times_out_once(runtime):
+    runtime.pending_timeout_s = 0.3
+    runtime.pending_poll_interval_s = 0.05
+    started = threading.Event()
+
+    @tool(runtime, name="slow")
+    def slow():
+        started.set()
+        time.sleep(1.0)
+
+    with runtime.agent_session(name="timeout"):
+        owner = threading.Thread(target=contextvars.copy_context().run, args=(slow,))
+        owner.start()
+        started.wait()
+        began = time.monotonic()
+        with pytest.raises(TimeoutError):
+            slow()
+        waited = time.monotonic() - began
+        owner.join()
+
+    # The event wait and the database polling share one pending_timeout_s.
+    assert waited < 0.55
+
+
+def test_export_run_iter_matches_export_run(runtime):
+    @tool(runtime, name="fetch")
+    def fetch(key):
+        return {"key": key}
+
+    with runtime.agent_session(name="export") as session:
+        for key in "abc":
+            fetch(key)
+
+    streamed = list(runtime.export_run_iter(session.run_id))
+    assert streamed == runtime.export_run(session.run_id)["tool_calls"]
+    assert [c["seq_no"] for c in streamed] == [1, 2, 3]
@@ -0,0 +1,52 @@
+import functools
+
+import pytest
+
+from agent_relay.runtime import AgentRuntime
+from agent_relay.tooling import tool
+
+
+@pytest.fixture
+def runtime(tmp_path):
+    rt = AgentRuntime.from_connection_string(f"sqlite+pysqlite:///{tmp_path / 'agenttrail.db'}")
+    yield rt
+    rt.close()
+
+
+def _tool_names(runtime, run_id):
+    return [c["tool_name"] for c in runtime.export_run(run_id)["tool_calls"]]
+
+
+def test_redecorating_a_tool_does_not_stack_wrappers(runtime):
+    def fetch(key):
+        return key
+
+    fetch = tool(runtime, name="fetch")(tool(runtime, name="fetch")(fetch))
+    with runtime.agent_session(name="redecorate") as session:
+        assert fetch("a") == "a"
+
+    assert _tool_names(runtime, session.run_id) == ["fetch"]
+
+
+def test_foreign_decorator_between_tools_is_kept(runtime):
+    audit = []
+
+    def audited(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            audit.append(args)
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    @tool(runtime, name="outer")
+    @audited
+    @tool(runtime, name="inner")
+    def fetch(key):
+        return key
+
+    with runtime.agent_session(name="stacked") as session:
+        assert fetch("a") == "a"
+
+    assert audit == [("a",)]
+    assert _tool_names(runtime, session.run_id) == ["outer", "inner"]